@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2024 Kristof Mulier.
+"""
+# SUMMARY:
+# This module holds the analysis part of fix_include_statements.py: it checks the include statements
+# found in the codebase against the filenames in the filesystem. It is pure Python, but fully typed,
+# such that it can optionally be compiled to a C extension with mypyc for extra speed:
+#
+#     > pip install mypy
+#     > mypyc _analyze.py
+#
+# This produces an '_analyze.*.so' (or '.pyd') file next to this one, which Python then imports
+# instead of this source file. Remove that file to fall back to the pure Python version.
+import sys
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# Cache for _lower_key(), mapping filenames to their (interned) lower case form.
+_LOWER_CACHE: Dict[str, str] = {}
+
+def _lower_key(filename: str) -> str:
+    '''
+    Returns the interned lower case form of the filename, used as key in the case-insensitive
+    filename index. The result is cached, as the same filenames come by over and over again, both
+    in the filesystem and in the include statements. str.lower() is used instead of
+    str.casefold(), as it is a lot faster and good enough for filenames.
+    '''
+    try:
+        return _LOWER_CACHE[filename]
+    except KeyError:
+        key = _LOWER_CACHE[filename] = sys.intern(filename.lower())
+        return key
+
+def _basename(include_statement_value: str) -> str:
+    '''
+    Returns the filename part of an include statement value. Both forward slashes and backslashes
+    are treated as separators. If there is no separator, rfind() returns -1 and the full value is
+    returned.
+    '''
+    return include_statement_value[
+        max(include_statement_value.rfind('/'), include_statement_value.rfind('\\')) + 1:
+    ]
+
+def _issue(include_statement_value: str,
+           actual_filenames: List[Optional[str]],
+           actual_paths: List[Optional[str]],
+           ) -> Dict[str, list]:
+    '''
+    Builds the description of an include statement issue. A value of None in the actual filenames
+    and paths means that only the backslashes need to be corrected. The corrected include statement
+    values are computed here as well, such that they are built only once per unique include value.
+    '''
+    correct_values: List[str] = []
+    for actual_filename in actual_filenames:
+        if actual_filename is None:
+            # Just correct the backslashes
+            correct_values.append(include_statement_value.replace('\\', '/'))
+        else:
+            correct_values.append(
+                include_statement_value.replace(
+                    _basename(include_statement_value), actual_filename
+                ).replace('\\', '/')
+            )
+    return {
+        'actual_filenames': actual_filenames,
+        'actual_paths'    : actual_paths,
+        'correct_values'  : correct_values,
+    }
+
+def _classify(include_statement_value: str,
+              all_filenames: Dict[str, List[Tuple[str, str]]],
+              ) -> Optional[Dict[str, list]]:
+    '''
+    Checks one include statement value against the filenames in the filesystem. Returns the
+    description of the issue (see _issue()), or None if the include statement is fine.
+    '''
+    include_filename = _basename(include_statement_value)
+    # Extract the matches - a list of tuples with the actual filename and its relative path. Each
+    # tuple is a possible candidate for the file that the include statement refers to. There are
+    # no matches if the include statement refers to a file that does not exist in the filesystem,
+    # for example a file from the compiler toolchain (eg. string.h).
+    matches: List[Tuple[str, str]] = all_filenames.get(_lower_key(include_filename), [])
+    actual_filenames: List[Optional[str]] = [actual_filename for actual_filename, _ in matches]
+
+    # The filename needs a correction if there are candidates, but none of them has exactly the
+    # same case as the include statement.
+    if matches and include_filename not in actual_filenames:
+        actual_paths: List[Optional[str]] = [actual_path for _, actual_path in matches]
+        return _issue(include_statement_value, actual_filenames, actual_paths)
+    # The filename is fine (or unknown). Still check for backslashes.
+    if '\\' in include_statement_value:
+        return _issue(include_statement_value, [None, ], [None, ])
+    return None
+
+def _analyze(include_dict: Dict[str, List[str]],
+             all_filenames: Dict[str, List[Tuple[str, str]]],
+             ) -> Dict[str, Dict[str, Dict[str, list]]]:
+    '''
+    Checks all the include statements in the codebase. Returns a dictionary with the relative path
+    of each file that has include statement issues as key, and a dictionary with the include
+    statement values and their issue descriptions (see _issue()) as value.
+    '''
+    results: Dict[str, Dict[str, Dict[str, list]]] = defaultdict(dict)
+    issues: Dict[str, Optional[Dict[str, list]]] = {}
+    # Loop over all the files and their include statements
+    for path, include_list in include_dict.items():
+        # Loop over all the include statements in the file (more precisely - the values of these
+        # include statements, which are the filenames of the included files, or sometimes relative
+        # paths to the included files).
+        for include_statement_value in include_list:
+            # The same header is typically included from many files. Check each unique include
+            # statement value only once.
+            try:
+                issue = issues[include_statement_value]
+            except KeyError:
+                issue = issues[include_statement_value] = _classify(include_statement_value, all_filenames)
+            if issue is not None:
+                results[path][include_statement_value] = issue
+    return results
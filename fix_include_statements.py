@@ -13,8 +13,44 @@ Copyright 2024 Kristof Mulier.
 import os
 import re
 import argparse
+import mmap
 import sys
-from typing import Dict, List, Tuple
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, FrozenSet, Iterator, List, Tuple, Union
+
+# The analysis of the include statements lives in a separate module, such that it can optionally be
+# compiled to a C extension with mypyc (see _analyze.py). If the extension is present, Python
+# imports it instead of the source file. Otherwise, the pure Python version is used.
+from _analyze import _analyze, _lower_key
+
+# File extensions of the source files that are taken into account.
+EXTS: FrozenSet[str] = frozenset(('.h', '.hpp', '.c', '.cpp'))
+
+# Directories that are never descended into: version control metadata, build output and the like.
+# Extra directory names can be given with the '--exclude-dir' option.
+EXCLUDE_DIRS: FrozenSet[str] = frozenset((
+    '.git', '.hg', '.svn', 'build', 'out', 'node_modules', '__pycache__', '.venv',
+))
+
+# Regex to extract the value of an include statement. It operates on the raw bytes of the file, so
+# the files don't need to be decoded. Include statements are ASCII anyhow. The value stops at the
+# first closing quote or angle bracket and cannot span multiple lines.
+INCLUDE_RE = re.compile(rb'#include\s*["<]([^">\r\n]*)[">]')
+
+# Same as INCLUDE_RE, but it captures all the parts of the include statement, such that it can be
+# rebuilt with another value: the whitespace, the opening delimiter, the value and the closing
+# delimiter.
+INCLUDE_RE_FULL = re.compile(rb'#include(\s*)(["<])([^">\r\n]*)([">])')
+
+# Files larger than this (in bytes) are memory mapped instead of read, such that the regex can scan
+# the page cache directly without copying the file into a bytes object first. For small files, the
+# cost of setting up the mapping is higher than the cost of the copy.
+MMAP_THRESHOLD: int = 64 * 1024
+
+# Minimal time between two progress updates, in seconds.
+PROGRESS_INTERVAL: float = 0.25
 
 def print_help() -> None:
     '''
@@ -45,6 +81,12 @@ def print_help() -> None:
         "  --directory=DIRECTORY                        to process. If not provided,\n"
         "                                               the current directory is used.\n"
         "\n"
+        "  -x NAME,                                     Name of a directory to skip (can be\n"
+        "  --exclude-dir=NAME                           repeated). These come on top of the\n"
+        "                                               default excluded directories:\n"
+        "                                               .git, .hg, .svn, build, out,\n"
+        "                                               node_modules, __pycache__, .venv\n"
+        "\n"
         "Examples:\n"
         "---------\n"
         "  Show the inconsistencies in the codebase, assuming that this script is in the \n"
@@ -57,185 +99,201 @@ def print_help() -> None:
     )
     return
 
-def crawl_codebase(root_dir: str) -> Dict[str, List[str]]:
+def _print_progress(i: int, unit: str, last_print: float) -> float:
+    '''
+    Rewrites the progress line with the number of processed items, but only if the previous update
+    is older than PROGRESS_INTERVAL. Returns the time of the last update.
+    '''
+    now = time.monotonic()
+    if now - last_print < PROGRESS_INTERVAL:
+        return last_print
+    sys.stdout.write(f"\r{i} {unit}")
+    # The line has no newline yet, so it must be flushed explicitly to show up in the terminal.
+    # Thanks to the throttling, this happens at most a few times per second.
+    sys.stdout.flush()
+    return now
+
+def _iter_source_files(root_dir: str,
+                       exclude_dirs: FrozenSet[str] = EXCLUDE_DIRS,
+                       ) -> Iterator[Tuple[str, str, str]]:
     '''
-    Crawls the codebase and returns a dictionary with the relative path of each file as key and a
-    list of its includes as value.
+    Walks the codebase with os.scandir() and yields a (relative_path, abs_path, filename) tuple for
+    each file with one of the extensions in EXTS. The relative path always uses forward slashes.
+    Directories are visited in the same (top-down) order as os.walk() would visit them. Directories
+    whose name is in exclude_dirs are pruned, so they are not even read.
+    '''
+    # Stack of (absolute directory path, relative prefix) tuples still to be visited.
+    stack: List[Tuple[str, str]] = [(root_dir, '')]
+    while stack:
+        dir_path, prefix = stack.pop()
+        subdirs: List[Tuple[str, str]] = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    name = entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if name not in exclude_dirs:
+                                subdirs.append((entry.path, prefix + name + '/'))
+                            continue
+                        # Extension check: a single search from the end and a set lookup
+                        dot = name.rfind('.')
+                        if dot < 0 or name[dot:] not in EXTS or not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    yield prefix + name, entry.path, name
+        except OSError:
+            # Unreadable directory. Skip it, just like os.walk() does.
+            continue
+        # Push the subdirectories in reverse order, such that they get popped in listing order.
+        stack.extend(reversed(subdirs))
+    return
+
+def _find_includes(content: Union[bytes, mmap.mmap]) -> List[bytes]:
+    '''
+    Returns the raw values of all include statements in the content. Files without any '#include'
+    are rejected with a plain substring search first, which is cheaper than running the regex.
+    '''
+    if content.find(b'#include') < 0:
+        return []
+    return INCLUDE_RE.findall(content)
+
+def _scan_one(relative_path: str, file_path: str) -> Tuple[str, List[str]]:
+    '''
+    Reads one file and returns its relative path together with the list of its includes. A file that
+    cannot be read (eg. it was removed after the directory walk, or it is unreadable) is reported
+    and treated as a file without includes, just like _iter_source_files() skips unreadable entries.
+    '''
+    try:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+                try:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        matches: List[bytes] = _find_includes(mm)
+                except (OSError, ValueError):
+                    # Memory mapping is not supported for this file. Fall back to reading it.
+                    matches = _find_includes(f.read())
+            else:
+                matches = _find_includes(f.read())
+    except OSError as exc:
+        print(f"\nUnable to read '{relative_path}' ({exc.strerror}). Skipped.")
+        return relative_path, []
+    return relative_path, [m.decode('utf-8', 'replace') for m in matches]
+
+def scan_codebase(root_dir: str,
+                  exclude_dirs: FrozenSet[str] = EXCLUDE_DIRS,
+                  ) -> Tuple[Dict[str, List[str]], Dict[str, List[Tuple[str, str]]]]:
+    '''
+    Crawls the codebase in a single pass and returns two dictionaries:
+      - include_dict: the relative path of each file as key and a list of its includes as value.
+      - filename_dict: lower case filenames as key, mapped to a list of their actual cases and
+        relative paths in the filesystem.
+    Only files with extensions .h, .hpp, .c, and .cpp are taken into account, and directories in
+    exclude_dirs are skipped. The directory walk itself is sequential, but the files are read and
+    parsed on a pool of threads.
     '''
-    include_pattern = re.compile(r'#include\s*["<](.*?)[">]')
     include_dict: Dict[str, List[str]] = {}
+    filename_dict: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+    relative_paths: List[str] = []
+    file_paths: List[str] = []
 
     print("Crawling the codebase")
+    for relative_path, file_path, filename in _iter_source_files(root_dir, exclude_dirs):
+        lower_filename = _lower_key(filename)
+        filename_dict[lower_filename].append((filename, relative_path))
+        relative_paths.append(relative_path)
+        file_paths.append(file_path)
+
+    # Read the files in parallel. The file reads release the GIL, so threads scale well here.
+    # Executor.map() yields the results in submission order, so the include dictionary is filled
+    # in the same order as the directory walk, without the need for a lock.
     i = 0
-    for root, dirs, files in os.walk(root_dir):
-        for filename in files:
-            if not filename.endswith(('.h', '.hpp', '.c', '.cpp')):
-                continue
-            file_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(file_path, start=root_dir).replace('\\', '/')
-            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-                content = f.read()
-                include_list: List[str] = include_pattern.findall(content)
-                # include_list = [include.replace('\\', '/') for include in include_list]
-                if include_list:
-                    include_dict[relative_path] = include_list
+    last_print = time.monotonic()
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for relative_path, include_list in executor.map(_scan_one, relative_paths, file_paths):
+            if include_list:
+                include_dict[relative_path] = include_list
             i += 1
             if i % 100 == 0:
-                print(".", end="")
-                sys.stdout.flush()
-            continue
-        continue
-    print("")
-    return include_dict
+                last_print = _print_progress(i, "files", last_print)
+    sys.stdout.write(f"\r{i} files\n")
+    return include_dict, filename_dict
 
-def list_all_files(root_dir: str) -> Dict[str, List[Tuple[str, str]]]:
+def _apply_edits(file_path: str, edits: List[Tuple[str, str]]) -> Tuple[int, int]:
     '''
-    Lists all filenames in the codebase with extensions .h, .hpp, .c, and .cpp, mapping lower case
-    filenames to their actual cases and relative paths in the filesystem.
+    Applies all the (include_statement_value, correct_include_statement_value) edits to the given
+    file. The file is opened once, read, all include statements are rewritten in a single regex
+    pass, and the result is written back in place through the same file object. Both the
+    '#include "..."' and '#include <...>' forms are handled. The file is processed as raw bytes, so
+    its encoding and line endings are left untouched. If the file cannot be opened or read (eg. it
+    is read-only), none of the edits are applied and they all count as errors. If writing the file
+    fails halfway (eg. disk full), the file may be partly overwritten: this is reported, such that
+    the user can restore it from the backup, and all the edits count as errors as well. Returns the
+    number of fixed include statements and the number of errors.
     '''
-    filename_dict: Dict[str, List[Tuple[str, str]]] = {}
+    replacements: Dict[bytes, bytes] = {
+        old.encode('utf-8'): new.encode('utf-8') for old, new in edits
+    }
+    # The delimiters of the include statements that were rewritten, for each replaced value
+    delimiters: Dict[bytes, Tuple[str, str]] = {}
 
-    print("Listing all filenames")
-    i = 0
-    for root, dirs, files in os.walk(root_dir):
-        for filename in files:
-            if not filename.endswith(('.h', '.hpp', '.c', '.cpp')):
-                continue
-            file_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(file_path, start=root_dir).replace('\\', '/')
-            lower_filename = filename.lower()
-            if lower_filename not in filename_dict:
-                filename_dict[lower_filename] = [(filename, relative_path)]
-            else:
-                filename_dict[lower_filename].append((filename, relative_path))
-            i += 1
-            if i % 100 == 0:
-                print(".", end="")
-                sys.stdout.flush()
+    def repl(m: 're.Match[bytes]') -> bytes:
+        value = m.group(3)
+        new_value = replacements.get(value)
+        if new_value is None:
+            return m.group(0)
+        delimiters.setdefault(value, (m.group(2).decode(), m.group(4).decode()))
+        return b'#include' + m.group(1) + m.group(2) + new_value + m.group(4)
+
+    # Set once the file starts being overwritten. From then on, an error can leave it damaged.
+    rewriting = False
+    try:
+        with open(file_path, 'r+b') as f:
+            old_content = f.read()
+            new_content = INCLUDE_RE_FULL.sub(repl, old_content)
+            if new_content != old_content:
+                rewriting = True
+                f.seek(0)
+                f.write(new_content)
+                # Cut off whatever remains of the old content, in case the new content is shorter.
+                f.truncate()
+    except OSError as exc:
+        if rewriting:
+            print(f"    ERROR: Writing the file failed ({exc.strerror}). It may be damaged! Restore it from the backup and fix its include statements manually.")
+        else:
+            for include_statement_value, _ in edits:
+                print(f"    Unable to correct include statement '#include \"{include_statement_value}\"' ({exc.strerror}). Do it manually. Skipped.")
+        return 0, len(edits)
+
+    fixed = 0
+    errors = 0
+    for include_statement_value, correct_include_statement_value in edits:
+        try:
+            opening, closing = delimiters[include_statement_value.encode('utf-8')]
+        except KeyError:
+            print(f"    Unable to correct include statement '#include \"{include_statement_value}\"'. Do it manually. Skipped.")
+            errors += 1
             continue
-        continue
-    print("")
-    return filename_dict
+        print(f"    Fixed include statement from '#include {opening}{include_statement_value}{closing}' to '#include {opening}{correct_include_statement_value}{closing}'.")
+        fixed += 1
+    return fixed, errors
 
-def check_codebase(root_dir: str, dry_run:bool) -> None:
+def check_codebase(root_dir: str, dry_run:bool, exclude_dirs: FrozenSet[str] = EXCLUDE_DIRS) -> None:
     '''
     Checks the codebase for inconsistencies between the include statements in the files and the
     actual filenames in the filesystem, and corrects backslashes in include statements to use
-    forward slashes.
+    forward slashes. Directories whose name is in exclude_dirs are skipped.
     '''
-    include_dict: Dict[str, List[str]] = crawl_codebase(root_dir)
-    all_filenames: Dict[str, List[Tuple[str, str]]] = list_all_files(root_dir)
+    include_dict: Dict[str, List[str]]
+    all_filenames: Dict[str, List[Tuple[str, str]]]
+    include_dict, all_filenames = scan_codebase(root_dir, exclude_dirs)
 
-    results = {}
     print("Analyzing the codebase")
-    i = 0
-    # Loop over all the files and their include statements
-    for path, include_list in include_dict.items():
-        # Loop over all the include statements in the file (more precisely - the values of these
-        # include statements, which are the filenames of the included files, or sometimes relative
-        # paths to the included files).
-        for include_statement_value in include_list:
-            i += 1
-            if i % 100 == 0:
-                print(".", end="")
-                sys.stdout.flush()
-            include_filename_lower = include_statement_value.replace('\\', '/').split('/')[-1].lower()
-            if include_filename_lower not in all_filenames:
-                # The include statement refers to a file that does not exist in the filesystem. This
-                # could be an include from a file in the compiler toolchain (eg. string.h). We skip,
-                # but not before checking for backslashes.
-                if '\\' in include_statement_value:
-                    if path in results:
-                        results[path][include_statement_value] = {
-                            'actual_filenames': [None, ],
-                            'actual_paths'    : [None, ],
-                        }
-                    else:
-                        results[path] = {
-                            include_statement_value: {
-                                'actual_filenames': [None, ],
-                                'actual_paths'    : [None, ],
-                            },
-                        }
-                continue
-
-            # Extract the matches - a list of tuples with the actual filename and its relative path.
-            # Each tuple is a possible candidate for the file that the include statement refers to.
-            matches: List[Tuple[str, str]] = all_filenames[include_filename_lower]
-
-            # Only one match
-            if len(matches) == 1:
-                actual_filename, actual_path = matches[0]
-                if actual_filename != include_statement_value.replace('\\', '/').split('/')[-1]:
-                    if path in results:
-                        results[path][include_statement_value] = {
-                            'actual_filenames': [actual_filename, ],
-                            'actual_paths'    : [actual_path, ],
-                        }
-                    else:
-                        results[path] = {
-                            include_statement_value: {
-                                'actual_filenames': [actual_filename, ],
-                                'actual_paths'    : [actual_path, ],
-                            },
-                        }
-                else:
-                    # Still check for backslashes
-                    if '\\' in include_statement_value:
-                        if path in results:
-                            results[path][include_statement_value] = {
-                                'actual_filenames': [None, ],
-                                'actual_paths'    : [None, ],
-                            }
-                        else:
-                            results[path] = {
-                                include_statement_value: {
-                                    'actual_filenames': [None, ],
-                                    'actual_paths'    : [None, ],
-                                },
-                            }
-            # Multiple matches
-            else:
-                actual_filenames = []
-                actual_paths = []
-                filename_matches: bool = False
-                for match in matches:
-                    actual_filename, actual_path = match
-                    actual_filenames.append(actual_filename)
-                    actual_paths.append(actual_path)
-                    if actual_filename == include_statement_value.replace('\\', '/').split('/')[-1]:
-                        filename_matches = True
-                if not filename_matches:
-                    if path in results:
-                        results[path][include_statement_value] = {
-                            'actual_filenames': actual_filenames,
-                            'actual_paths'    : actual_paths,
-                        }
-                    else:
-                        results[path] = {
-                            include_statement_value: {
-                                'actual_filenames': actual_filenames,
-                                'actual_paths'    : actual_paths,
-                            },
-                        }
-                else:
-                    # Still check for backslashes
-                    if '\\' in include_statement_value:
-                        if path in results:
-                            results[path][include_statement_value] = {
-                                'actual_filenames': [None, ],
-                                'actual_paths'    : [None, ],
-                            }
-                        else:
-                            results[path] = {
-                                include_statement_value: {
-                                    'actual_filenames': [None, ],
-                                    'actual_paths'    : [None, ],
-                                },
-                            }
-            continue
-        continue
-    print("\n")
+    results: Dict[str, Dict[str, Dict[str, list]]] = _analyze(include_dict, all_filenames)
+    print(f"{sum(len(include_list) for include_list in include_dict.values())} include statements")
+    print("")
     print("Results:")
     print("========")
     n = len(results)
@@ -253,29 +311,23 @@ def check_codebase(root_dir: str, dry_run:bool) -> None:
     for path in results.keys():
         k += 1
         print(f"File({k}/{n}): {path}")
+        # The chosen corrections for this file. They are applied all at once, after the last include
+        # statement of the file has been handled.
+        pending_edits: List[Tuple[str, str]] = []
         for include_statement_value, actual_filenames_and_paths in results[path].items():
             print(f"    '#include \"{include_statement_value}\"'")
             if len(actual_filenames_and_paths['actual_filenames']) == 1:
                 print(f"        Should be:")
             else:
                 print(f"        Should be one of:")
-            correct_include_statement_values = []
+            correct_include_statement_values = actual_filenames_and_paths['correct_values']
             for j in range(len(actual_filenames_and_paths['actual_filenames'])):
                 actual_filename = actual_filenames_and_paths['actual_filenames'][j]
                 actual_path = actual_filenames_and_paths['actual_paths'][j]
                 if actual_filename is None:
-                    # Just correct the backslashes
-                    correct_include_statement_values.append(
-                        include_statement_value.replace('\\', '/')
-                    )
-                    print(f"        {j + 1}: '#include \"{correct_include_statement_values[-1]}\"'")
+                    print(f"        {j + 1}: '#include \"{correct_include_statement_values[j]}\"'")
                 else:
-                    correct_include_statement_values.append(
-                        include_statement_value.replace(
-                            include_statement_value.replace('\\', '/').split('/')[-1], actual_filename
-                        ).replace('\\', '/')
-                    )
-                    print(f"        {j + 1}: '#include \"{correct_include_statement_values[-1]}\"' ({actual_path})")
+                    print(f"        {j + 1}: '#include \"{correct_include_statement_values[j]}\"' ({actual_path})")
             print(f"        {j + 2}: Skip")
             print(f"        {j + 3}: Fix all {n} files automatically")
             print(f"        {j + 4}: Skip all - quit program")
@@ -298,6 +350,9 @@ def check_codebase(root_dir: str, dry_run:bool) -> None:
                     chosen_nr = '1'
                 if chosen_nr == str(j + 4):
                     print(f"        Quitting program.")
+                    # Don't lose the corrections that were already chosen for this file
+                    if pending_edits:
+                        _apply_edits(os.path.join(root_dir, path), pending_edits)
                     sys.exit(0)
                 try:
                     chosen_nr = int(chosen_nr)
@@ -313,29 +368,13 @@ def check_codebase(root_dir: str, dry_run:bool) -> None:
                     print("\n")
                     s += 1
                     continue
-                with open(os.path.join(root_dir, path), 'r', encoding='utf-8', errors='replace') as f:
-                    old_content = f.read()
-                correct_with_quotes = True
-                new_content = old_content.replace(f'#include \"{include_statement_value}\"', f'#include \"{correct_include_statement_value}\"')
-                if new_content == old_content:
-                    # The include statement was probably with '<>' instead of '""'
-                    correct_with_quotes = False
-                    new_content = old_content.replace(f'#include <{include_statement_value}>', f'#include <{correct_include_statement_value}>')
-                    if new_content == old_content:
-                        print(f"        Unable to correct include statement. Do it manually. Skipped.")
-                        print("\n")
-                        e += 1
-                        continue
-                with open(os.path.join(root_dir, path), 'w', encoding='utf-8', errors='replace') as f:
-                    f.write(new_content)
-                if correct_with_quotes:
-                    print(f"    Fixed include statement from '#include \"{include_statement_value}\"' to '#include \"{correct_include_statement_value}\"'.")
-                else:
-                    print(f"    Fixed include statement from '#include <{include_statement_value}>' to '#include <{correct_include_statement_value}>'.")
-                g += 1
+                pending_edits.append((include_statement_value, correct_include_statement_value))
+            print("\n")
+        if pending_edits:
+            fixed, errors = _apply_edits(os.path.join(root_dir, path), pending_edits)
+            g += fixed
+            e += errors
             print("\n")
-            continue
-        continue
 
     print(f"Summary:")
     print(f"========")
@@ -366,6 +405,14 @@ if __name__ == '__main__':
         help='The root directory of the codebase to check (default: .)',
         default=os.getcwd(),
     )
+    parser.add_argument(
+        '-x',
+        '--exclude-dir',
+        action='append',
+        type=str,
+        help='Name of a directory to skip, on top of the default ones (can be repeated)',
+        default=[],
+    )
 
     # Override the default help message with a custom one
     parser.print_help = print_help
@@ -396,5 +443,5 @@ if __name__ == '__main__':
             sys.exit(0)
     
     # Check the codebase for inconsistencies
-    check_codebase(args.directory, args.dry_run)
+    check_codebase(args.directory, args.dry_run, EXCLUDE_DIRS | frozenset(args.exclude_dir))
     sys.exit(0)